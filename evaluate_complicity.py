@@ -5,10 +5,20 @@ import argparse
 import csv
 import json
 import yaml
+import hashlib
+import mmap
+import sqlite3
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing, contextmanager
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
 
 import psycopg2
+import psycopg2.pool
+from psycopg2 import sql
 from sql_metadata import Parser
-import sqlparse
 import logging
 
 from rich.logging import RichHandler
@@ -19,198 +29,406 @@ logging.basicConfig(
 )
 logger = logging.getLogger("rich")
 
+_VIEW_RE = re.compile(r"CREATE OR REPLACE VIEW (\w+\.\w+)")
+_STRIP_RE = re.compile(
+    rb"^.*(?:CREATE OR REPLACE VIEW|WITH NO SCHEMA BINDING).*\n?", re.MULTILINE
+)
 
-def get_connection():
-    return psycopg2.connect(**DATABASE_CONFIG)
+# Functions and keywords that sql_metadata may mistake for tables
+_TABLE_BLACKLIST = frozenset(
+    {
+        "current_date",
+        "date_trunc",
+        "current_timestamp",
+        "case",
+        "lower",
+        "nvl",
+        "count",
+        "sum",
+        "position",
+    }
+)
 
+_REGEXP_FUNCTIONS = [
+    "regexp_substr",
+    "regexp_replace",
+    "regexp_instr",
+    "regexp_count",
+]
+_SQL_OPERATORS = [
+    "json_extract_path",
+    "nvl",
+    "coalesce",
+    "group by",
+    "order by",
+    "having",
+    "distinct",
+    "listagg",
+    "split_part",
+    "substring",
+    "over",
+    "date_trunc",
+    "date_part",
+    "json_parse",
+    "json_serialize",
+]
+# Redshift variants of the tracked functions, counted as the base function
+_FUNCTION_VARIANTS = {
+    "nvl2": "nvl",
+    "date_part_year": "date_part",
+    "json_extract_path_text": "json_extract_path",
+}
+# Keywords are counted on the raw bytes of the file, as whole words only
+# (so that "case_id" is not a CASE), with any whitespace between the words
+_SQL_KEYWORDS_RE = re.compile(
+    rb"\b(?:"
+    + b"|".join(
+        re.escape(keyword.encode()).replace(rb"\ ", rb"\s+")
+        # Longest first, so that "cross join" wins over "join"
+        for keyword in sorted(
+            [
+                "join",
+                "cross join",
+                "case",
+                "union",
+                *_REGEXP_FUNCTIONS,
+                *_SQL_OPERATORS,
+                *_FUNCTION_VARIANTS,
+            ],
+            key=len,
+            reverse=True,
+        )
+    )
+    + rb")\b"
+)
 
-def get_table_columns(table_name, db_report_schema):
-    query = """
-       SELECT column_name
-        FROM svv_columns
-       WHERE table_schema = %s
-             AND table_name = %s
-    ORDER BY ordinal_position;
-    """
-    with get_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                query,
-                (
-                    db_report_schema,
-                    table_name,
-                ),
-            )
-            return [row[0] for row in cur.fetchall()]
+# Bump whenever the parsing results change, so that the cached ones are recomputed
+_PARSE_VERSION = b"3"
+_CACHE_TABLE_DDL = """
+CREATE TABLE IF NOT EXISTS parsed_files (
+    path TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    parsed TEXT NOT NULL
+)
+"""
 
+_POOL = None
 
-def get_table_size(table_name, db_report_schema):
-    query = f"""
-    DROP TABLE IF EXISTS evaluation_tmp
-    ;
-    CREATE TEMPORARY table evaluation_tmp AS
-    SELECT *
-      FROM {db_report_schema}.{table_name}
-    ;
-    ANALYZE evaluation_tmp;
-    SELECT size
-     FROM svv_table_info
-    WHERE "table" = 'evaluation_tmp'
-    ;
+
+def get_pool():
+    """Creates the connection pool on first use, so that all lookups share warm sessions"""
+    global _POOL
+    if _POOL is None:
+        _POOL = psycopg2.pool.ThreadedConnectionPool(1, 8, **DATABASE_CONFIG)
+    return _POOL
+
+
+def close_pool():
+    global _POOL
+    if _POOL is not None:
+        _POOL.closeall()
+        _POOL = None
+
+
+@contextmanager
+def get_connection():
+    pool = get_pool()
+    conn = pool.getconn()
+    # Every lookup is independent; a failed query must not abort the following ones
+    conn.autocommit = True
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+
+def get_tables_columns(conn, table_names, db_report_schema):
+    """Fetches the columns of all the given tables in a single round trip"""
+    if not table_names:
+        return {}
+    query = """
+       SELECT table_name,
+              column_name
+         FROM svv_columns
+        WHERE table_schema = %s
+              AND table_name IN %s
+     ORDER BY table_name,
+              ordinal_position;
     """
-    with get_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(query)
-            result = cur.fetchall()
-            return result[0]
+    with conn.cursor() as cur:
+        cur.execute(
+            query,
+            (
+                db_report_schema,
+                tuple(table_names),
+            ),
+        )
+        # svv_columns is a leader-node catalog view, so Redshift cannot aggregate
+        # it with LISTAGG/ARRAY_AGG; the ordered rows are grouped off the cursor
+        # instead, without materializing them with fetchall()
+        return {
+            table_name: [column_name for _, column_name in rows]
+            for table_name, rows in groupby(cur, key=itemgetter(0))
+        }
 
 
-def get_table_rows(table_name, db_report_schema):
-    query = f"""
-    SELECT COUNT(1)
-      FROM {db_report_schema}.{table_name}
+def get_tables_size(conn, table_names):
+    """Reads the size (in 1 MB blocks) of the given schema-qualified tables"""
+    if not table_names:
+        return {}
+    query = """
+    SELECT "schema" || '.' || "table",
+           size
+      FROM svv_table_info
+     WHERE "schema" || '.' || "table" IN %s
     ;
     """
-    with get_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(query)
-            result = cur.fetchall()
-            return result[0]
+    with conn.cursor() as cur:
+        cur.execute(query, (tuple(table_names),))
+        return dict(cur.fetchall())
+
+
+def qualify_table_name(table_name, db_report_schema):
+    return table_name if "." in table_name else f"{db_report_schema}.{table_name}"
+
+
+def get_tables_rows(conn, table_names, db_report_schema):
+    """Counts the rows of all the given tables in a single round trip"""
+    if not table_names:
+        return {}
+    # Identifiers are quoted by the driver instead of being pasted into the text
+    query = sql.SQL("\nUNION ALL\n").join(
+        sql.SQL("""
+    SELECT %s,
+           COUNT(1)
+      FROM {}
+    """).format(sql.Identifier(db_report_schema, table_name))
+        for table_name in table_names
+    )
+    with conn.cursor() as cur:
+        cur.execute(query, tuple(table_names))
+        return dict(cur.fetchall())
 
 
 def find_sql_files(folder_path):
-    return [
-        os.path.join(root, file)
-        for root, _, files in os.walk(folder_path)
-        for file in files
-        if file.endswith(".sql")
-    ]
+    folders = [folder_path]
+    while folders:
+        folder = folders.pop()
+        try:
+            entries = os.scandir(folder)
+        except OSError as e:
+            # Like os.walk, skip the folders that cannot be read
+            logger.error(f"Error reading the folder {folder}: {e}")
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                elif entry.name.endswith(".sql"):
+                    yield entry.path
 
 
 def get_file_content(file_path):
-    pattern = r"CREATE OR REPLACE VIEW (\w+\.\w+)"
-    with open(file_path, "r") as sql_file:
-        first_line = sql_file.readline()
-        view_name = (
-            re.search(pattern, first_line).group(1)
-            if re.search(pattern, first_line)
-            else None
-        )
-        sql_content = "".join(
-            line
-            for line in sql_file
-            if "WITH NO SCHEMA BINDING" not in line
-            and "CREATE OR REPLACE VIEW" not in line
-        )
+    """Returns the SQL body as UTF-8 bytes along with the view name"""
+    if not os.path.getsize(file_path):
+        return b"", None
+    with open(file_path, "rb") as sql_file, mmap.mmap(
+        sql_file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as sql_map:
+        # A BOM or indentation must not hide the header from re.match
+        first_line = sql_map.readline().decode("utf-8-sig").lstrip()
+        view_match = _VIEW_RE.match(first_line)
+        view_name = view_match.group(1) if view_match else None
+        sql_content = _STRIP_RE.sub(b"", sql_map[sql_map.tell() :])
     return sql_content, view_name
 
 
-def count_sql_elements(sql_content):
-    lower_sql = sql_content.lower()
+def count_sql_keywords(sql_content):
+    """Counts all the tracked keywords in a single pass over the SQL bytes"""
+    keywords = (
+        b" ".join(keyword.split()).decode()
+        for keyword in _SQL_KEYWORDS_RE.findall(sql_content.lower())
+    )
+    return Counter(_FUNCTION_VARIANTS.get(keyword, keyword) for keyword in keywords)
+
+
+def count_sql_elements(keyword_counts):
     elements = {
-        "join_count": lower_sql.count("join"),
-        "cross_join_count": lower_sql.count("cross join"),
-        "case_count": lower_sql.count("case"),
-        "union_count": lower_sql.count("union"),
-        "regexp_count": sum(
-            lower_sql.count(func)
-            for func in [
-                "regexp_substr",
-                "regexp_replace",
-                "regexp_instr",
-                "regexp_count",
-            ]
-        ),
+        # "cross join" is matched as a whole, but it is a join all the same
+        "join_count": keyword_counts["join"] + keyword_counts["cross join"],
+        "cross_join_count": keyword_counts["cross join"],
+        "case_count": keyword_counts["case"],
+        "union_count": keyword_counts["union"],
+        "regexp_count": sum(keyword_counts[func] for func in _REGEXP_FUNCTIONS),
     }
     return elements
 
 
-def count_sql_operators(sql_content):
-    operators = [
-        "json_extract_path",
-        "nvl",
-        "coalesce",
-        "group by",
-        "order by",
-        "having",
-        "distinct",
-        "listagg",
-        "split_part",
-        "substring",
-        "over",
-        "date_trunc",
-        "date_part",
-        "json_parse",
-        "json_serialize",
-    ]
-    return sum(sql_content.lower().count(op.lower()) for op in operators)
+def count_sql_operators(keyword_counts):
+    return sum(keyword_counts[op] for op in _SQL_OPERATORS)
 
 
 def to_csv(json_data, output_file="output.csv"):
-    headers = json_data[0].keys()
+    """Writes the rows as they arrive, taking the headers from the first one"""
+    json_data = iter(json_data)
+    first_row = next(json_data, None)
+    if first_row is None:
+        logger.warning("Nothing to report")
+        return
     with open(output_file, "w", newline="") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=headers, delimiter="|")
+        writer = csv.DictWriter(csvfile, fieldnames=first_row.keys(), delimiter="|")
         writer.writeheader()
+        writer.writerow(first_row)
         writer.writerows(json_data)
         logger.warning(f"Report was saved into {output_file}")
 
 
-def analyze_sql_files(file_path, db_search, db_report_schema):
-    sql_file_paths = find_sql_files(file_path)
-    logger.info(f"Found {len(sql_file_paths)} files to analyze")
-    stats = []
+@lru_cache(maxsize=None)
+def parse_sql_content(sql_content):
+    sql_parsed_lib_sql_metadata = Parser(sql_content.decode())
+
+    keyword_counts = count_sql_keywords(sql_content)
+
+    tables_used = [
+        table
+        for table in sql_parsed_lib_sql_metadata.tables
+        if table.lower() not in _TABLE_BLACKLIST
+    ]
+
+    return {
+        "tables_used": tables_used,
+        "cte_used": sql_parsed_lib_sql_metadata.with_names,
+        "subqueries_used": sql_parsed_lib_sql_metadata.subqueries_names,
+        "sql_elements": count_sql_elements(keyword_counts),
+        "sql_operators": count_sql_operators(keyword_counts),
+    }
+
+
+def load_cache(cache_file):
+    """Loads the parsing results of the previous runs, keyed by the file path"""
+    with closing(sqlite3.connect(cache_file)) as cache_db:
+        cache_db.execute(_CACHE_TABLE_DDL)
+        return {
+            sql_file_path: (content_hash, json.loads(parsed))
+            for sql_file_path, content_hash, parsed in cache_db.execute(
+                "SELECT path, sha256, parsed FROM parsed_files"
+            )
+        }
+
+
+def save_cache(cache_file, cache):
+    with closing(sqlite3.connect(cache_file)) as cache_db, cache_db:
+        cache_db.execute(_CACHE_TABLE_DDL)
+        cache_db.executemany(
+            "INSERT OR REPLACE INTO parsed_files VALUES (?, ?, ?)",
+            (
+                (sql_file_path, content_hash, json.dumps(parsed))
+                for sql_file_path, (content_hash, parsed) in cache.items()
+            ),
+        )
+
+
+def parse_sql_files(sql_file_paths, cache):
+    """Parses the files in parallel, skipping the ones unchanged since the last run"""
+    sql_files = []
     for sql_file_path in sql_file_paths:
         logger.info(f"Working on the file: {sql_file_path}")
-
         sql_content, view_name = get_file_content(sql_file_path)
-        sql_parsed_lib_sql_parse = sqlparse.parse(sql_content)[0]
-        sql_parsed_lib_sql_metadata = Parser(sql_content)
-
-        tables_used = [
-            table
-            for table in sql_parsed_lib_sql_metadata.tables
-            if table.lower()
-            not in (
-                "current_date",
-                "date_trunc",
-                "current_timestamp",
-                "case",
-                "lower",
-                "nvl",
-                "count",
-                "sum",
-                "position",
-            )
-        ]
-        cte_used = sql_parsed_lib_sql_metadata.with_names
-        subqueries_used = sql_parsed_lib_sql_metadata.subqueries_names
+        content_hash = hashlib.sha256(_PARSE_VERSION + sql_content).hexdigest()
+        sql_files.append((sql_file_path, view_name, sql_content, content_hash))
+
+    # Identical content is parsed only once
+    to_parse = {
+        content_hash: sql_content
+        for sql_file_path, _, sql_content, content_hash in sql_files
+        if cache.get(sql_file_path, (None, None))[0] != content_hash
+    }
+    with ProcessPoolExecutor() as executor:
+        parsed_contents = dict(
+            zip(to_parse, executor.map(parse_sql_content, to_parse.values()))
+        )
+    for sql_file_path, _, _, content_hash in sql_files:
+        if content_hash in parsed_contents:
+            cache[sql_file_path] = (content_hash, parsed_contents[content_hash])
+
+    return [
+        {
+            "view_name": view_name,
+            "sql_file_path": sql_file_path,
+            **cache[sql_file_path][1],
+        }
+        for sql_file_path, view_name, _, _ in sql_files
+    ]
+
 
-        sql_elements = count_sql_elements(sql_parsed_lib_sql_parse.value)
-        sql_operators = count_sql_operators(sql_parsed_lib_sql_parse.value)
-        columns = get_table_columns(view_name.split(".")[1], db_report_schema)
+def analyze_sql_files(file_path, db_search, db_report_schema, cache_file=None):
+    sql_file_paths = list(find_sql_files(file_path))
+    logger.info(f"Found {len(sql_file_paths)} files to analyze")
+
+    # First pass: parse the files, collecting the views to look up in the DWH.
+    # Parsing needs no DB access, so it is spread over worker processes
+    cache = load_cache(cache_file) if cache_file else {}
+    parsed_files = parse_sql_files(sql_file_paths, cache)
+    if cache_file:
+        save_cache(cache_file, cache)
+
+    table_names = list(
+        dict.fromkeys(parsed["view_name"].split(".")[1] for parsed in parsed_files)
+    )
+
+    # Second pass: fetch the metadata of all the views at once
+    with get_connection() as conn:
+        tables_columns = get_tables_columns(conn, table_names, db_report_schema)
+        if db_search:
+            # A view has no storage of its own, so its size is estimated
+            # as the total size of the base tables it reads from
+            base_table_names = list(
+                dict.fromkeys(
+                    qualify_table_name(table, db_report_schema)
+                    for parsed in parsed_files
+                    for table in parsed["tables_used"]
+                )
+            )
+            tables_size = get_tables_size(conn, base_table_names)
+            tables_rows = get_tables_rows(conn, table_names, db_report_schema)
+
+    for parsed in parsed_files:
+        view_name = parsed["view_name"]
+        table_name = view_name.split(".")[1]
+        tables_used = parsed["tables_used"]
+        cte_used = parsed["cte_used"]
+        subqueries_used = parsed["subqueries_used"]
+        sql_elements = parsed["sql_elements"]
+        join_count = sql_elements["join_count"]
+        case_count = sql_elements["case_count"]
+        union_count = sql_elements["union_count"]
+        cross_join_count = sql_elements["cross_join_count"]
+        regexp_count = sql_elements["regexp_count"]
+        sql_operators = parsed["sql_operators"]
+        columns = tables_columns.get(table_name, [])
 
         data = {
             "view_name": view_name,
-            "sql_file_path": sql_file_path,
+            "sql_file_path": parsed["sql_file_path"],
             "score": (len(tables_used) * 0.2)
             + (sql_operators * 0.1)
-            + (sql_elements.get("join_count") * 0.3)
+            + (join_count * 0.3)
             + (len(subqueries_used) * 0.5)
             + (len(cte_used) * 0.5)
-            + (sql_elements.get("case_count") * 0.2)
-            + (sql_elements.get("union_count") * 0.4)
-            + (sql_elements.get("cross_join_count") * 0.7)
-            + (sql_elements.get("regexp_count") * 0.6),
+            + (case_count * 0.2)
+            + (union_count * 0.4)
+            + (cross_join_count * 0.7)
+            + (regexp_count * 0.6),
             "tables_used_cnt": len(tables_used),
             "columns_cnt": len(columns),
             "sql_operators_cnt": sql_operators,
-            "join_cnt": sql_elements.get("join_count"),
+            "join_cnt": join_count,
             "subqueries_used_cnt": len(subqueries_used),
             "cte_used_cnt": len(cte_used),
-            "case_cnt": sql_elements.get("case_count"),
-            "union_cnt": sql_elements.get("union_count"),
-            "cross_join_cnt": sql_elements.get("cross_join_count"),
-            "regexp_cnt": sql_elements.get("regexp_count"),
+            "case_cnt": case_count,
+            "union_cnt": union_count,
+            "cross_join_cnt": cross_join_count,
+            "regexp_cnt": regexp_count,
             "columns": columns,
             "tables_used": tables_used,
             "cte_used": cte_used,
@@ -218,12 +436,19 @@ def analyze_sql_files(file_path, db_search, db_report_schema):
         }
 
         if db_search:
-            data["size_mb"] = get_table_size(view_name.split(".")[1], db_report_schema)
-            data["rows_cnt"] = get_table_rows(view_name.split(".")[1], db_report_schema)
-
-        stats.append(data)
+            base_tables_size = [
+                tables_size[base_table_name]
+                for base_table_name in (
+                    qualify_table_name(table, db_report_schema) for table in tables_used
+                )
+                if base_table_name in tables_size
+            ]
+            # None rather than 0 when no base table was found in the catalog
+            # (views over views, external tables, wrongly guessed schemas)
+            data["size_mb"] = sum(base_tables_size) if base_tables_size else None
+            data["rows_cnt"] = tables_rows.get(table_name)
 
-    return stats
+        yield data
 
 
 if __name__ == "__main__":
@@ -249,11 +474,24 @@ if __name__ == "__main__":
         default="public",
         help="DWH schema of the report view",
     )
+    parser.add_argument(
+        "--cache_file",
+        type=str,
+        default=".sql_report_cache.sqlite",
+        help="SQLite file to cache parsing results between runs, empty to disable",
+    )
 
     args = parser.parse_args()
 
     with open(args.db_config, "r") as file:
         DATABASE_CONFIG = yaml.safe_load(file)
 
-    stats = analyze_sql_files(args.file_path, args.db_search, args.db_report_schema)
-    to_csv(stats)
+    try:
+        # analyze_sql_files is lazy, so the pool must outlive the CSV writing
+        to_csv(
+            analyze_sql_files(
+                args.file_path, args.db_search, args.db_report_schema, args.cache_file
+            )
+        )
+    finally:
+        close_pool()
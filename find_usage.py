@@ -3,11 +3,17 @@ import os
 import re
 import argparse
 import json
+import hashlib
+import sqlite3
 import logging
 from rich.logging import RichHandler
 from rich.text import Text
 
 import warnings
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+from functools import lru_cache, partial
+from itertools import chain
 
 from sqlparse import parse
 from sqlparse.sql import Identifier, IdentifierList
@@ -19,85 +25,123 @@ logging.basicConfig(
 )
 logger = logging.getLogger("rich")
 
+_VIEW_RE = re.compile(r"CREATE OR REPLACE VIEW (\w+\.\w+)")
+_STRIP_RE = re.compile(
+    r"^.*(?:CREATE OR REPLACE VIEW|WITH NO SCHEMA BINDING).*\n?", re.MULTILINE
+)
+
+# Bump whenever the column usage search changes (including sql_metadata
+# upgrades), so that the cached results are recomputed
+_USAGE_VERSION = 1
+_CACHE_TABLE_DDL = """
+CREATE TABLE IF NOT EXISTS column_usage (
+    path TEXT NOT NULL,
+    target TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    used_columns TEXT NOT NULL,
+    PRIMARY KEY (path, target)
+)
+"""
+
+# Extended list of SQL keywords for filtering
+_SQL_KEYWORDS = frozenset(
+    {
+        "SELECT",
+        "FROM",
+        "JOIN",
+        "LEFT",
+        "RIGHT",
+        "INNER",
+        "OUTER",
+        "WHERE",
+        "GROUP",
+        "ORDER",
+        "BY",
+        "ON",
+        "AS",
+        "WITH",
+        "AND",
+        "OR",
+        "NULL",
+        "HAVING",
+        "DISTINCT",
+        "LIMIT",
+        "OFFSET",
+        "UNION",
+        "INTERSECT",
+        "INNER JOIN",
+        "LEFT JOIN",
+        "FULL JOIN",
+        "FULL OUTER JOIN",
+        "UNION ALL",
+        "RIGHT JOIN",
+        "OUTER JOIN",
+        "GROUP BY",
+        "ORDER BY",
+    }
+)
+
 
 def find_sql_files(folder_path):
     """Finds all SQL files in the specified folder and subfolder"""
-    return [
-        os.path.join(root, file)
-        for root, _, files in os.walk(folder_path)
-        for file in files
-        if file.endswith(".sql")
-    ]
+    folders = [folder_path]
+    while folders:
+        folder = folders.pop()
+        try:
+            entries = os.scandir(folder)
+        except OSError as e:
+            # Like os.walk, skip the folders that cannot be read
+            logger.error(f"Error reading the folder {folder}: {e}")
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                elif entry.name.endswith(".sql"):
+                    yield entry.path
 
 
 def get_file_content(file_path):
     """Reads the contents of the file and extracts the view name."""
-    pattern = r"CREATE OR REPLACE VIEW (\w+\.\w+)"
     try:
         with open(file_path, "r", encoding="utf-8") as sql_file:
             content = sql_file.read()
-            view_match = re.search(pattern, content)
+            view_match = _VIEW_RE.search(content)
             view_name = view_match.group(1) if view_match else None
             # Removing unnecessary lines
-            sql_content = "".join(
-                line
-                for line in content.split("\n")
-                if "WITH NO SCHEMA BINDING" not in line
-                and "CREATE OR REPLACE VIEW" not in line
-            )
+            sql_content = _STRIP_RE.sub("", content)
             return sql_content, view_name
     except Exception as e:
         logger.error(f"Error reading the file {file_path}: {e}")
         return None, None
 
 
+@lru_cache(maxsize=None)
+def parse_sql(sql_content):
+    """Parsing SQL using sql_metadata, once per distinct query"""
+    return Parser(sql_content)
+
+
 def find_column_usage(sql_content, target_schema, target_table, target_columns):
     """Searches for the usage of the specified columns from the table, taking aliases into account"""
+    used_columns, _ = _find_column_usage_cached(
+        sql_content, target_schema, target_table, frozenset(target_columns)
+    )
+    return set(used_columns)
+
+
+@lru_cache(maxsize=None)
+def _find_column_usage_cached(sql_content, target_schema, target_table, target_columns):
+    # Identical CTE bodies (within a file or across files) are only analyzed once.
+    # Returns the used columns and whether the query and all its CTEs were parsed
     try:
-        # Parsing SQL using sql_metadata.
-        parser = Parser(sql_content)
-
-        # Extended list of SQL keywords for filtering
-        sql_keywords = {
-            "SELECT",
-            "FROM",
-            "JOIN",
-            "LEFT",
-            "RIGHT",
-            "INNER",
-            "OUTER",
-            "WHERE",
-            "GROUP",
-            "ORDER",
-            "BY",
-            "ON",
-            "AS",
-            "WITH",
-            "AND",
-            "OR",
-            "NULL",
-            "HAVING",
-            "DISTINCT",
-            "LIMIT",
-            "OFFSET",
-            "UNION",
-            "INTERSECT",
-            "INNER JOIN",
-            "LEFT JOIN",
-            "FULL JOIN",
-            "FULL OUTER JOIN",
-            "UNION ALL",
-            "RIGHT JOIN",
-            "OUTER JOIN",
-            "GROUP BY",
-            "ORDER BY",
-        }
+        parser = parse_sql(sql_content)
 
         # Filtering tables_aliases, excluding keywords
         tables = {
             k: v
             for k, v in parser.tables_aliases.items()
-            if k.upper() not in sql_keywords
+            if k.upper() not in _SQL_KEYWORDS
         }
 
         # Getting all columns for verification
@@ -111,98 +155,167 @@ def find_column_usage(sql_content, target_schema, target_table, target_columns):
 
         # Filtering tables, excluding columns
         valid_tables = {}
+        values_set = set(tables.values())
+        value_to_alias = {v: k for k, v in tables.items()}
         for table in parser.tables:
             # If the 'table' contains a dot and matches a column, skip it
             if "." in table and table in all_columns:
                 continue
             # If the table already exists in tables as a value or is not a keyword
             if (
-                table not in tables.values()
+                table not in values_set
                 and table not in tables
-                and table.upper() not in sql_keywords
+                and table.upper() not in _SQL_KEYWORDS
             ):
                 valid_tables[table] = table
-            elif table in tables.values():
+            elif table in values_set:
                 # If it is a value from tables_aliases, save the original pair.
-                for alias, full_name in tables.items():
-                    if full_name == table:
-                        valid_tables[alias] = full_name
+                valid_tables[value_to_alias[table]] = table
 
         tables.update(valid_tables)
         logger.info(f"Extracted tables and aliases (filtered): {tables}")
 
+        # Column references may come as strings or as lists of strings
+        column_refs = chain.from_iterable(
+            ref if isinstance(ref, list) else (ref,) for ref in all_columns
+        )
+        qualified_target_table = f"{target_schema}.{target_table}"
+        dotted_target_table = f".{target_table}"
+
         used_columns = set()
-        for column_ref in all_columns:
-            # Checking if this is a string or a list
-            if isinstance(column_ref, list):
-                # If it's a list, process each element
-                for sub_ref in column_ref:
-                    if isinstance(sub_ref, str):
-                        parts = sub_ref.split(".")
-                        if len(parts) >= 2:
-                            table_or_alias = parts[-2].strip()
-                            column = parts[-1].strip()
-                            full_table = tables.get(table_or_alias, table_or_alias)
-                            if (
-                                f"{target_schema}.{target_table}" in full_table
-                                or target_table == full_table
-                                or full_table.endswith(f".{target_table}")
-                            ) and column in target_columns:
-                                used_columns.add(column)
-            elif isinstance(column_ref, str):
-                # A regular string
-                parts = column_ref.split(".")
-                if len(parts) >= 2:
-                    table_or_alias = parts[-2].strip()
-                    column = parts[-1].strip()
-                    full_table = tables.get(table_or_alias, table_or_alias)
-                    if (
-                        f"{target_schema}.{target_table}" in full_table
-                        or target_table == full_table
-                        or full_table.endswith(f".{target_table}")
-                    ) and column in target_columns:
-                        used_columns.add(column)
+        for column_ref in column_refs:
+            if not isinstance(column_ref, str):
+                continue
+            parts = column_ref.split(".")
+            if len(parts) >= 2:
+                table_or_alias = parts[-2].strip()
+                column = parts[-1].strip()
+                if column not in target_columns:
+                    continue
+                full_table = tables.get(table_or_alias, table_or_alias)
+                if (
+                    qualified_target_table in full_table
+                    or target_table == full_table
+                    or full_table.endswith(dotted_target_table)
+                ):
+                    used_columns.add(column)
 
         # Recursively process nested CTEs
+        parsed = True
         if parser.with_queries:
             logger.info("Processing CTE")
             for cte_name, cte_query in parser.with_queries.items():
                 logger.info(f"CTE {cte_name}")
-                cte_used_columns = find_column_usage(
+                cte_used_columns, cte_parsed = _find_column_usage_cached(
                     cte_query, target_schema, target_table, target_columns
                 )
-
-            if cte_used_columns:
                 used_columns.update(cte_used_columns)
+                parsed = parsed and cte_parsed
 
         logger.info(f"Found used columns: {used_columns}")
 
-        return used_columns
+        return frozenset(used_columns), parsed
     except Exception as e:
         logger.error(f"SQL parsing error: {e}")
-        return set()
+        return frozenset(), False
+
 
+def load_cache(cache_file, target):
+    """Loads the columns' usage found by the previous runs for the same target"""
+    with closing(sqlite3.connect(cache_file)) as cache_db:
+        cache_db.execute(_CACHE_TABLE_DDL)
+        return {
+            sql_file_path: (content_hash, json.loads(used_columns))
+            for sql_file_path, content_hash, used_columns in cache_db.execute(
+                "SELECT path, sha256, used_columns FROM column_usage WHERE target = ?",
+                (target,),
+            )
+        }
+
+
+def save_cache(cache_file, target, cache):
+    with closing(sqlite3.connect(cache_file)) as cache_db, cache_db:
+        cache_db.execute(_CACHE_TABLE_DDL)
+        cache_db.executemany(
+            "INSERT OR REPLACE INTO column_usage VALUES (?, ?, ?, ?)",
+            (
+                (sql_file_path, target, content_hash, json.dumps(used_columns))
+                for sql_file_path, (content_hash, used_columns) in cache.items()
+            ),
+        )
 
-def analyze_sql_files(folder_path, target_schema, target_table, target_columns):
+
+def analyze_sql_file(
+    sql_file_path, sql_content, target_schema, target_table, target_columns
+):
+    """Analyzes a single SQL file, returning the used columns and the parsing status."""
+    logger.info(f"File: {sql_file_path}")
+    used_columns, parsed = _find_column_usage_cached(
+        sql_content, target_schema, target_table, frozenset(target_columns)
+    )
+    logger.info("\n")
+    return sorted(used_columns), parsed
+
+
+def analyze_sql_files(
+    folder_path, target_schema, target_table, target_columns, cache_file=None
+):
     """Main function for analyzing SQL files."""
-    sql_file_paths = find_sql_files(folder_path)
+    sql_file_paths = list(find_sql_files(folder_path))
     results = {}
 
     logger.info(f"Found {len(sql_file_paths)} files to analyze")
 
+    # The cached usage is only valid for the same search code and target
+    target = json.dumps(
+        [_USAGE_VERSION, target_schema, target_table, sorted(target_columns)]
+    )
+    cache = load_cache(cache_file, target) if cache_file else {}
+
+    sql_files = []
     for sql_file_path in sql_file_paths:
         sql_content, view_name = get_file_content(sql_file_path)
         if sql_content:
-            logger.info(f"File: {sql_file_path}")
-            used_columns = find_column_usage(
-                sql_content, target_schema, target_table, target_columns
-            )
-            if used_columns:
-                results[sql_file_path] = {
-                    "view_name": view_name,
-                    "used_columns": list(used_columns),
-                }
-            logger.info("\n")
+            content_hash = hashlib.sha256(sql_content.encode()).hexdigest()
+            sql_files.append((sql_file_path, view_name, sql_content, content_hash))
+    changed_files = [
+        (sql_file_path, sql_content, content_hash)
+        for sql_file_path, _, sql_content, content_hash in sql_files
+        if cache.get(sql_file_path, (None, None))[0] != content_hash
+    ]
+
+    # Parsing is CPU-bound, so the changed files are spread over worker processes
+    files_used_columns = {}
+    with ProcessPoolExecutor() as executor:
+        files_usage = executor.map(
+            partial(
+                analyze_sql_file,
+                target_schema=target_schema,
+                target_table=target_table,
+                target_columns=target_columns,
+            ),
+            [sql_file_path for sql_file_path, _, _ in changed_files],
+            [sql_content for _, sql_content, _ in changed_files],
+        )
+        for (sql_file_path, _, content_hash), (used_columns, parsed) in zip(
+            changed_files, files_usage
+        ):
+            files_used_columns[sql_file_path] = used_columns
+            # Files with parsing errors are analyzed again on the next run
+            if parsed:
+                cache[sql_file_path] = (content_hash, used_columns)
+    if cache_file:
+        save_cache(cache_file, target, cache)
+
+    for sql_file_path, view_name, _, _ in sql_files:
+        used_columns = files_used_columns.get(sql_file_path)
+        if used_columns is None:
+            used_columns = cache[sql_file_path][1]
+        if used_columns:
+            results[sql_file_path] = {
+                "view_name": view_name,
+                "used_columns": used_columns,
+            }
 
     # Вывод результатов
     if results:
@@ -246,6 +359,12 @@ if __name__ == "__main__":
         default=target_columns,
         help="The list of columns in the table, the usage of which we will be searching for",
     )
+    parser.add_argument(
+        "--cache_file",
+        type=str,
+        default=".sql_report_cache.sqlite",
+        help="SQLite file to cache results between runs, empty to disable",
+    )
 
     args = parser.parse_args()
 
@@ -254,4 +373,5 @@ if __name__ == "__main__":
         args.target_schema,
         args.target_table,
         json.loads(args.target_columns),
+        args.cache_file,
     )